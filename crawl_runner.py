@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 import os, os.path, sys, subprocess
-import save_reader, getch
+import save_reader, getch, crawl_versions
 from common import *
 
 def wait_key():
@@ -40,9 +40,17 @@ def get_changelog(from_rev, to_rev):
         old_cwd = os.getcwd()
         try:
             os.chdir(source_dir)
-            with open(changelog_file, "wb") as f:
+            # Shallow clones are deepened by update, never fetch here
+            try:
+                complete = crawl_versions.history_complete(to_rev, from_rev)
+            except (OSError, subprocess.CalledProcessError):
+                complete = False
+            if not complete:
+                return "Changelog unavailable.\n"
+            with open(changelog_file + ".new", "wb") as f:
                 command = ["git", "log", "--reverse", from_rev + ".." + to_rev]
                 subprocess.check_call(command, stdout=f)
+            os.rename(changelog_file + ".new", changelog_file)
         finally:
             os.chdir(old_cwd)
 
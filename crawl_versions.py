@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
-import argparse, os, os.path, subprocess, yaml, traceback, sys, shutil, stat
-import save_reader
+import argparse, os, os.path, subprocess, yaml, traceback, sys, shutil, stat, time
+import multiprocessing
+import save_reader, scoring_index
 from common import *
 
 source_address = "git://gitorious.org/crawl/crawl.git"
@@ -13,12 +14,152 @@ def call_git(command, *args, **kwargs):
     else:
         subprocess.check_call(["git", command] + list(args))
 
+def call_git_succeeds(command, *args):
+    """Runs a git command quietly, returns whether it succeeded."""
+    with open(os.devnull, "w") as devnull:
+        return subprocess.call(["git", command] + list(args),
+                               stdout=devnull, stderr=devnull) == 0
+
+def source_refspecs(versions):
+    """Returns the refspecs needed to fetch the configured branches.
+    Branches of the form origin/<name> are fetched as remote branches.
+    Local branches and commits already present in the current repository
+    are used as they are, anything else is taken to be a tag."""
+    refspecs = []
+    for version in versions:
+        branch = version["branch"]
+        if branch.startswith("origin/"):
+            refspec = "+refs/heads/{0}:refs/remotes/{1}".format(branch[len("origin/"):], branch)
+        elif (not call_git_succeeds("rev-parse", "-q", "--verify", "refs/tags/" + branch) and
+              call_git_succeeds("cat-file", "-e", branch + "^{commit}")):
+            continue
+        else:
+            refspec = "+refs/tags/{0}:refs/tags/{0}".format(branch)
+        if refspec not in refspecs: refspecs.append(refspec)
+    return refspecs
+
+def _objects_size():
+    """Returns the size of the object store of the current repository in KiB."""
+    size = 0
+    for l in call_git("count-objects", "-v", output=True).splitlines():
+        (key, value) = l.split(":", 1)
+        if key in ["size", "size-pack"]:
+            size += int(value)
+    return size
+
+def _log_fetch(config, fetched, duration, description):
+    print "Fetched {0} KiB in {1:.1f}s".format(fetched, duration)
+    with open(os.path.join(base_dir, "fetch.log"), "a") as f:
+        f.write("{0} {1} {2} {3:.1f} {4}\n".format(
+            time.strftime("%Y-%m-%dT%H:%M:%S"), config.get("clone-mode", "full"),
+            fetched, duration, description))
+
+def fetch_source(config, versions, *args):
+    """Fetches the configured branches into the current repository and
+    records how much was downloaded. Returns False if there was nothing
+    to fetch."""
+    refspecs = source_refspecs(versions)
+    if not refspecs: return False
+    before = _objects_size()
+    start = time.time()
+    try:
+        call_git("fetch", *(list(args) + ["origin"] + refspecs))
+    except subprocess.CalledProcessError:
+        print "Fetching the configured branches failed!"
+        print "(Each branch must be origin/<branch>, a tag, or a local branch"
+        print "or commit already present in src.)"
+        sys.exit(1)
+    _log_fetch(config, _objects_size() - before, time.time() - start, " ".join(args))
+    return True
+
+def checkout_source(config, revision):
+    """Checks out the given revision in the current repository. Blobless
+    clones download the missing blobs here, so this is recorded as well."""
+    before = _objects_size()
+    start = time.time()
+    call_git("checkout", "-qf", revision)
+    fetched = _objects_size() - before
+    if fetched:
+        _log_fetch(config, fetched, time.time() - start, "checkout " + revision)
+
+def history_complete(rev, base):
+    """Checks that rev, base and all commits in between are present in
+    the current repository, i.e. that no shallow boundary cuts them off."""
+    if not (call_git_succeeds("cat-file", "-e", rev + "^{commit}") and
+            call_git_succeeds("cat-file", "-e", base + "^{commit}")):
+        return False
+    shallow_file = os.path.join(".git", "shallow")
+    if not os.path.isfile(shallow_file): return True
+    with open(shallow_file, "r") as f:
+        shallow = set(f.read().split())
+    commits = call_git("rev-list", rev, "--not", base, output=True).split()
+    return not shallow.intersection(commits)
+
+def describable(branch):
+    """Checks that git describe gives the same result for the branch as it
+    would with the full history."""
+    if not call_git_succeeds("describe", branch): return False
+    tag = call_git("describe", "--abbrev=0", branch, output=True).strip()
+    return history_complete(branch, tag)
+
+def deepen_source(config, versions, check):
+    """Deepens a shallow clone of the current repository until check()
+    succeeds or the full history is present."""
+    step = str(config.get("clone-depth", 100))
+    while not check() and os.path.isfile(os.path.join(".git", "shallow")):
+        if not fetch_source(config, versions, "--deepen", step): break
+
+def deepen_to_revisions(config, versions, branch, revisions):
+    """Deepens a shallow clone of the current repository until the history
+    from the branch back to each of the given revisions is complete."""
+    for rev in revisions:
+        deepen_source(config, versions, lambda: history_complete(branch, rev))
+
 def init_source():
     """Makes sure the crawl source is present, returns the directory."""
     source_dir = os.path.join(base_dir, "src")
     if os.path.isdir(source_dir): return source_dir
+    config = load_base_config()
+    versions = load_config()
+    mode = config.get("clone-mode", "full")
+    if mode not in ["full", "shallow", "blobless"]:
+        print "Unknown clone-mode {0} in config.yml!".format(mode)
+        print "(Should be one of full, shallow or blobless.)"
+        sys.exit(1)
+    if not versions:
+        print "Couldn't find any versions in the configuration directory!"
+        print "(Maybe copy from crawl-versions.d.example?)"
+        sys.exit(1)
     print "Downloading crawl source..."
-    call_git("clone", source_address, source_dir)
+    # Build the repository next to its final place, so that a failed
+    # download doesn't leave a half set up one behind
+    temp_dir = source_dir + ".new"
+    if os.path.isdir(temp_dir): shutil.rmtree(temp_dir)
+    call_git("init", "-q", temp_dir)
+    old_cwd = os.getcwd()
+    os.chdir(temp_dir)
+    try:
+        call_git("remote", "add", "origin", source_address)
+        # Plain "git fetch origin" should stay narrow as well
+        call_git("config", "--unset-all", "remote.origin.fetch")
+        for refspec in source_refspecs(versions):
+            call_git("config", "--add", "remote.origin.fetch", refspec)
+        if mode == "blobless":
+            call_git("config", "remote.origin.promisor", "true")
+            call_git("config", "remote.origin.partialclonefilter", "blob:none")
+            fetch_source(config, versions, "--filter=blob:none")
+        elif mode == "shallow":
+            fetch_source(config, versions, "--depth", str(config.get("clone-depth", 100)))
+        else:
+            fetch_source(config, versions)
+        checkout_source(config, versions[0]["branch"])
+    except:
+        os.chdir(old_cwd)
+        shutil.rmtree(temp_dir)
+        raise
+    finally:
+        os.chdir(old_cwd)
+    os.rename(temp_dir, source_dir)
     return source_dir
 
 def load_config():
@@ -49,6 +190,17 @@ def get_path(key, config, version, **kwargs):
     template = template or config.get("defaults", {}).get(key, None)
     return template and template.format(name=version["name"], **kwargs)
 
+def scoring_files(version):
+    """Returns (file type, filename, folder) for each logfile and
+    milestones file of the version."""
+    files = []
+    for (file_type, folder) in [("logfile", "shared"),
+                                ("milestones", "saves")]:
+        files.append((file_type, file_type, folder))
+        for game_mode in version.get("game-modes", []):
+            files.append((file_type, file_type + "-" + game_mode, folder))
+    return files
+
 def _find_major_version():
     line_start = "#define TAG_MAJOR_VERSION"
     with open("tag-version.h", "r") as f:
@@ -69,7 +221,7 @@ def compile_revision(version_name, revision):
     old_cwd = os.getcwd()
     os.chdir(os.path.join(source_dir, "crawl-ref", "source"))
     try:
-        call_git("checkout", "-qf", revision)
+        checkout_source(load_base_config(), revision)
         command = ["make",
                    "prefix=" + revision_dir,
                    "DATADIR=" + os.path.join(revision_dir, "data/"),
@@ -129,11 +281,8 @@ def _update_version(version, config):
                            os.path.join(scoring_link_dir, filename + ".new"))
                 os.rename(os.path.join(scoring_link_dir, filename + ".new"),
                           os.path.join(scoring_link_dir, filename))
-            for (file_type, folder) in [("logfile", "shared"),
-                                        ("milestones", "saves")]:
-                do_link(file_type, folder)
-                for game_mode in version.get("game-modes", []):
-                    do_link(file_type + "-" + game_mode, folder)
+            for (file_type, filename, folder) in scoring_files(version):
+                do_link(filename, folder)
 
         rcfile_dir_link = get_path("rcfile-dir-link", config, version)
         rcfile_dir = get_path("rcfile-dir", config, version)
@@ -153,12 +302,33 @@ def _update_version(version, config):
 def update(args):
     config = load_base_config()
     versions = load_config()
+    fresh = not os.path.isdir(os.path.join(base_dir, "src"))
     source_dir = init_source()
     os.chdir(source_dir)
-    call_git("fetch", "--all")
+    if not fresh:
+        fetch_source(config, versions)
+    # Shallow clones need enough history to describe the branches
+    # correctly, as the description names the revision
+    for version in versions:
+        deepen_source(config, versions, lambda: describable(version["branch"]))
     success = True
     for version in versions:
         success = success and _update_version(version, config)
+
+    # Changelogs are shown when upgrading from revisions still in use;
+    # make sure the history back to them is there
+    process_stats = process_statistics()
+    for version in versions:
+        version_dir = os.path.join(get_crawl_dir(), version["name"])
+        if not os.path.isdir(version_dir): continue
+        in_use = set(process_stats.get(version["name"], dict()))
+        for save_file in savefiles(version):
+            try:
+                in_use.add(savefile_revision(save_file))
+            except save_reader.SaveFileError:
+                pass
+        revisions = [rev for rev in installed_revisions(version) if rev in in_use]
+        deepen_to_revisions(config, versions, version["branch"], revisions)
     return 0 if success else 1
 
 def savefile_revision(save_file):
@@ -167,19 +337,33 @@ def savefile_revision(save_file):
         p.read_chr_chunk()
         return p.crawl_version
 
-def savefile_statistics(version):
-    """Counts save files for each revision of the version."""
+def savefiles(version):
+    """Yields the paths of all save files of the version."""
     save_dir = os.path.join(get_crawl_dir(), version["name"], "saves")
-    stats = dict()
     for game_mode in [None] + game_modes:
         mode_save_dir = os.path.join(save_dir, game_mode) if game_mode else save_dir
         if not os.path.isdir(mode_save_dir): continue
         for save_file in os.listdir(mode_save_dir):
             if not save_file.endswith(".cs"): continue
-            rev = savefile_revision(os.path.join(mode_save_dir, save_file))
-            stats[rev] = 1 + stats.get(rev, 0)
+            yield os.path.join(mode_save_dir, save_file)
+
+def savefile_statistics(version):
+    """Counts save files for each revision of the version."""
+    stats = dict()
+    for save_file in savefiles(version):
+        rev = savefile_revision(save_file)
+        stats[rev] = 1 + stats.get(rev, 0)
     return stats
 
+def verify_savefile(save_file):
+    """Checks all chunks of a save file. Returns the file name and a list
+    of (chunk name, error) pairs."""
+    try:
+        with save_reader.Package(save_file) as p:
+            return (save_file, p.verify())
+    except (save_reader.SaveFileError, IOError) as e:
+        return (save_file, [("<package>", str(e))])
+
 def installed_revisions(version):
     """Returns a list of all revisions installed for a given version."""
     version_dir = os.path.join(get_crawl_dir(), version["name"])
@@ -256,6 +440,7 @@ def list_revisions(args):
         print
 
 def blacklist(args):
+    base_config = load_base_config()
     config = load_config()
     if args.versions:
         versions = args.versions
@@ -264,6 +449,11 @@ def blacklist(args):
 
     source_dir = init_source()
     os.chdir(source_dir)
+    # A shallow clone may not contain the installed revisions yet
+    for version in config:
+        if version["name"] not in versions: continue
+        deepen_to_revisions(base_config, config, version["branch"],
+                            installed_revisions(version))
     try:
         rev_range_parsed = call_git("rev-parse", *args.data, output=True)
     except subprocess.CalledProcessError:
@@ -276,6 +466,17 @@ def blacklist(args):
         ranges = args.ranges
 
     if ranges:
+        # The range must not be cut off by a shallow boundary; without a
+        # lower bound that means the full history
+        positive = [rev for rev in revs if not rev.startswith("^")]
+        negative = [rev[1:] for rev in revs if rev.startswith("^")]
+        for rev in positive:
+            if negative:
+                for base in negative:
+                    deepen_source(base_config, config,
+                                  lambda: history_complete(rev, base))
+            else:
+                deepen_source(base_config, config, lambda: False)
         revs = call_git("rev-list", *revs, output=True).split()
 
     for version in config:
@@ -336,6 +537,67 @@ def clean(args):
 
         print
 
+def verify(args):
+    config = load_config()
+    if args.versions:
+        versions = args.versions
+    else:
+        versions = [v["name"] for v in config]
+
+    files = []
+    for version in config:
+        if version["name"] not in versions: continue
+        files.extend(savefiles(version))
+
+    print "Verifying {0} save files...".format(len(files))
+    pool = multiprocessing.Pool(args.jobs)
+    bad = []
+    try:
+        for (save_file, problems) in pool.imap_unordered(verify_savefile, files, 16):
+            if problems: bad.append((save_file, problems))
+    finally:
+        pool.terminate()
+
+    bad.sort()
+    with open(args.report, "w") as f:
+        for (save_file, problems) in bad:
+            f.write(save_file + "\n")
+            for (chunk, error) in problems:
+                f.write("  {0}: {1}\n".format(chunk, error))
+    print "{0} corrupt save files, see {1}".format(len(bad), args.report)
+    return 1 if bad else 0
+
+def stats(args):
+    config = load_base_config()
+    versions = load_config()
+    if args.versions:
+        version_names = args.versions
+    else:
+        version_names = [v["name"] for v in versions]
+
+    sources = []
+    for version in versions:
+        scoring_link_dir = get_path("scoring-link-dir", config, version)
+        if not scoring_link_dir: continue
+        for (file_type, filename, folder) in scoring_files(version):
+            sources.append((version["name"], file_type,
+                            os.path.join(base_dir, scoring_link_dir, filename)))
+
+    with scoring_index.ScoringIndex(os.path.join(base_dir, "scoring-index.db")) as index:
+        added = index.update(sources)
+        print added, "new records"
+        print
+
+        for version_name in version_names:
+            counts = index.count(version=version_name, player=args.player)
+            print "{0}: {1} games, {2} milestones".format(
+                version_name, counts.get("logfile", 0), counts.get("milestones", 0))
+            last = index.query(version=version_name, player=args.player,
+                               limit=1, latest_first=True)
+            if last:
+                print "last activity:", last[0][5]
+    return 0
+
 def init_user(username):
     config = load_base_config()
     versions = load_config()
@@ -379,6 +641,18 @@ if __name__ == "__main__":
     parser_clean.set_defaults(func=clean)
     parser_clean.add_argument("-v", "--version", dest="versions", action="append")
 
+    parser_verify = subparsers.add_parser("verify", help="Check save files for corruption.")
+    parser_verify.set_defaults(func=verify)
+    parser_verify.add_argument("-v", "--version", dest="versions", action="append")
+    parser_verify.add_argument("-j", "--jobs", dest="jobs", type=int, default=None)
+    parser_verify.add_argument("-o", "--report", dest="report",
+                               default=os.path.join(base_dir, "quarantine-report.txt"))
+
+    parser_stats = subparsers.add_parser("stats", help="Update the scoring index and show statistics.")
+    parser_stats.set_defaults(func=stats)
+    parser_stats.add_argument("-v", "--version", dest="versions", action="append")
+    parser_stats.add_argument("-p", "--player", dest="player")
+
     args = parser.parse_args()
     if args.func:
         sys.exit(args.func(args))
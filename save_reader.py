@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import os
 import struct
 import zlib
 import sys
@@ -33,11 +34,13 @@ class Package(object):
             self._read_directory(start, self.version)
         except:
             self.close()
+            raise
 
     def _read_directory(self, start, version):
         if version != 1:
             raise SaveFileError("unsupported package version")
 
+        self.directory_start = start
         rd = ChunkReader(self, start)
         def _read_entry():
             data = rd.read(1)
@@ -46,7 +49,7 @@ class Package(object):
                 name = rd.read(l)
                 if len(name) < l:
                     raise SaveFileError("save file corrupted -- truncated directory")
-                (start,) = struct.unpack("<I", rd.read(4))
+                (start,) = rd.read_format("<I")
                 self.directory[name] = start
                 return True
             else:
@@ -60,6 +63,20 @@ class Package(object):
         else:
             return None
 
+    def verify(self):
+        """Reads through every chunk, checking the block chain and the
+        compressed data. Returns a list of (chunk name, error) pairs."""
+        problems = []
+        seen_blocks = set()
+        chunks = [("<directory>", self.directory_start)]
+        chunks += sorted(self.directory.items())
+        for (name, start) in chunks:
+            try:
+                ChunkReader(self, start).verify(seen_blocks)
+            except SaveFileError as e:
+                problems.append((name, str(e)))
+        return problems
+
     def close(self):
         if self.f:
             self.f.close()
@@ -125,16 +142,59 @@ class ChunkReader(object):
 
         return data
     
+    def verify(self, seen_blocks):
+        """Streams through the whole chunk without keeping the data.
+        seen_blocks holds the blocks of the package already visited, a
+        block belonging to two chunks is a bad link."""
+        f = self.package.f
+        file_size = os.fstat(f.fileno()).st_size
+        block = self.first_block
+        while block:
+            if block in seen_blocks:
+                raise SaveFileError("save file corrupted -- block linked twice")
+            if (block < Package.file_header.size or
+                block + ChunkReader.block_header.size > file_size):
+                raise SaveFileError("save file corrupted -- bad block link")
+            seen_blocks.add(block)
+            f.seek(block)
+            (length, next_block) = self._read_block_header()
+            if block + ChunkReader.block_header.size + length > file_size:
+                raise SaveFileError("save file corrupted -- truncated block")
+            while length:
+                data = f.read(min(length, 65536))
+                length -= len(data)
+                try:
+                    while data:
+                        self.zlib.decompress(data, 65536)
+                        data = self.zlib.unconsumed_tail
+                except zlib.error as e:
+                    raise SaveFileError("save file corrupted -- " + str(e))
+            block = next_block
+
+        # Feed a byte past the end; it only shows up as unused data if the
+        # compressed stream was complete.
+        probe = self.zlib.copy()
+        unused = len(probe.unused_data)
+        try:
+            probe.decompress(b"\0")
+        except zlib.error:
+            pass
+        if len(probe.unused_data) == unused:
+            raise SaveFileError("save file corrupted -- truncated compressed data")
+
     def read(self, l):
         decompressed = bytes()
-        while len(decompressed) < l:
-            if self.zlib.unconsumed_tail:
-                decompressed += self.zlib.decompress(self.zlib.unconsumed_tail, l - len(decompressed))
-            else:
-                data = self._raw_read(1024)
-                decompressed += self.zlib.decompress(data, l - len(decompressed))
-                if len(data) < 1024:
-                    return decompressed
+        try:
+            while len(decompressed) < l:
+                if self.zlib.unconsumed_tail:
+                    decompressed += self.zlib.decompress(self.zlib.unconsumed_tail, l - len(decompressed))
+                else:
+                    data = self._raw_read(1024)
+                    decompressed += self.zlib.decompress(data, l - len(decompressed))
+                    if len(data) < 1024:
+                        return decompressed
+        except zlib.error as e:
+            raise SaveFileError("save file corrupted -- " + str(e))
         return decompressed
     
     def read_all(self):
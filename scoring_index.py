@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+import os, os.path, sqlite3, sys
+
+def parse_record(line):
+    """Parses a crawl logfile/milestones line (key=value:key=value...).
+    A literal colon inside a value is written as "::"."""
+    record = dict()
+    field = ""
+    i = 0
+    line = line.rstrip("\n")
+    while i <= len(line):
+        if i == len(line) or line[i] == ":":
+            if i + 1 < len(line) and line[i + 1] == ":":
+                field += ":"
+                i += 2
+                continue
+            if "=" in field:
+                (key, value) = field.split("=", 1)
+                record[key] = value
+            field = ""
+        else:
+            field += line[i]
+        i += 1
+    return record
+
+def record_time(record):
+    """Returns the time of a record: the end time for logfile entries,
+    the milestone time for milestones."""
+    return record.get("end") or record.get("time")
+
+class ScoringIndex(object):
+    """Incrementally tails the logfiles and milestones of all versions.
+
+    The index is an sqlite database. Each tailed file is entered once in
+    the files table together with its version, type and the byte offset
+    read up to; only lines appended since are read on an update. For each
+    record only the file, offset, player and time are kept, indexed by
+    player and time; the full record can be read back with read_record."""
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE NOT NULL,
+                type TEXT NOT NULL,
+                version TEXT NOT NULL,
+                inode INTEGER,
+                offset INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS records (
+                file INTEGER NOT NULL,
+                offset INTEGER NOT NULL,
+                player TEXT NOT NULL,
+                time TEXT);
+            CREATE INDEX IF NOT EXISTS records_player ON records (player, time);
+            CREATE INDEX IF NOT EXISTS records_file ON records (file, time);
+        """)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _file(self, version_name, file_type, path):
+        """Returns (id, inode, offset) for the file, entering it if new."""
+        row = self.db.execute("SELECT id, inode, offset, type, version FROM files"
+                              " WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            cursor = self.db.execute("INSERT INTO files (path, type, version)"
+                                     " VALUES (?, ?, ?)",
+                                     (path, file_type, version_name))
+            return (cursor.lastrowid, None, 0)
+        if row[3:] != (file_type, version_name):
+            self.db.execute("UPDATE files SET type = ?, version = ? WHERE id = ?",
+                            (file_type, version_name, row[0]))
+        return row[:3]
+
+    def update_file(self, version_name, file_type, path):
+        """Reads new records from the given file. Returns the number of
+        records added."""
+        if not os.path.isfile(path): return 0
+        st = os.stat(os.path.realpath(path))
+        (file_id, inode, offset) = self._file(version_name, file_type, path)
+        if inode is not None and (inode != st.st_ino or offset > st.st_size):
+            # File was replaced or truncated, start over
+            self.db.execute("DELETE FROM records WHERE file = ?", (file_id,))
+            offset = 0
+        if inode == st.st_ino and offset == st.st_size: return 0
+
+        added = 0
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                # Leave incomplete lines for the next update
+                if not line.endswith("\n"): break
+                record = parse_record(line)
+                if "name" in record:
+                    self.db.execute("INSERT INTO records VALUES (?, ?, ?, ?)",
+                                    (file_id, offset, record["name"].decode("utf-8", "replace"),
+                                     record_time(record)))
+                    added += 1
+                offset += len(line)
+        self.db.execute("UPDATE files SET inode = ?, offset = ? WHERE id = ?",
+                        (st.st_ino, offset, file_id))
+        return added
+
+    def update(self, sources):
+        """Updates the index from (version name, file type, path) triples.
+        Returns the number of records added."""
+        added = 0
+        with self.db:
+            for (version_name, file_type, path) in sources:
+                added += self.update_file(version_name, file_type, path)
+        return added
+
+    def _where(self, version, player, since, until, file_type):
+        conditions = []
+        params = []
+        for (condition, value) in [("files.version = ?", version),
+                                   ("records.player = ?", player),
+                                   ("records.time >= ?", since),
+                                   ("records.time < ?", until),
+                                   ("files.type = ?", file_type)]:
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        return (where, params)
+
+    def query(self, version=None, player=None, since=None, until=None,
+              file_type=None, limit=None, latest_first=False):
+        """Returns the (version, file type, path, offset, player, time)
+        entries matching all the given criteria, sorted by time."""
+        (where, params) = self._where(version, player, since, until, file_type)
+        sql = ("SELECT files.version, files.type, files.path, records.offset,"
+               " records.player, records.time"
+               " FROM records JOIN files ON records.file = files.id" + where +
+               " ORDER BY records.time" + (" DESC" if latest_first else ""))
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self.db.execute(sql, params).fetchall()
+
+    def count(self, version=None, player=None, since=None, until=None):
+        """Returns the number of matching records for each file type."""
+        (where, params) = self._where(version, player, since, until, None)
+        return dict(self.db.execute(
+            "SELECT files.type, count(*)"
+            " FROM records JOIN files ON records.file = files.id" + where +
+            " GROUP BY files.type", params).fetchall())
+
+    def read_record(self, entry):
+        """Reads the full record for an entry returned by query."""
+        with open(entry[2], "rb") as f:
+            f.seek(entry[3])
+            return parse_record(f.readline())
+
+if __name__ == "__main__":
+    with ScoringIndex(sys.argv[1]) as index:
+        for entry in index.query(player=sys.argv[2] if len(sys.argv) > 2 else None):
+            print entry[0], entry[1], entry[4], entry[5]